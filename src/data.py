@@ -1,13 +1,21 @@
 import yfinance as yf
 import pandas as pd
 import numpy as np
-from scipy.stats import zscore
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from tqdm import tqdm
 import time
 import asyncio
-import aiohttp
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from aiolimiter import AsyncLimiter
+from diskcache import Cache
+from datetime import datetime, timezone
+from curl_cffi import requests as curl_requests
+from curl_cffi import CurlHttpVersion
 import os
-from typing import Dict, List
+import warnings
+from typing import Dict, List, Tuple
 
 #######################
 # MASTER VARIABLES
@@ -77,15 +85,48 @@ METRICS = {
     "all_metrics": ALL_METRICS
 }
 
+# Z-score column names for each category's composite score
+RISK_Z_COLS = [f"{metric}_ZScore" for metric in X1_RISK_METRICS]
+MOMENTUM_Z_COLS = [f"{metric}_ZScore" for metric in X2_MOMENTUM_METRICS]
+QUALITY_Z_COLS = [f"{metric}_ZScore" for metric in X3_QUALITY_METRICS]
+
 # API Settings
-MAX_CONCURRENT_REQUESTS = 2
-REQUEST_DELAY = 0.5  # seconds
-INDUSTRY_DELAY = 1.0  # seconds
+API_CALLS_PER_SECOND = 20  # yfinance calls started per second (info, history, sector lookups)
+MAX_WORKER_THREADS = 32  # Threads running blocking yfinance calls
+
+# Cache Settings
+CACHE_DIR = ".yf_cache"
+CACHE_EXPIRY = 86400  # seconds
 
 #######################
 # CODE
 #######################
 
+# The HTTP session and the disk cache (which lets same-day re-runs skip the API)
+# are created on first use, so importing this module, as the dashboard does,
+# doesn't open a session or create CACHE_DIR
+_shared_session = None
+_cache = None
+
+def get_shared_session() -> curl_requests.Session:
+    """Get the curl_cffi session shared by every yfinance request, creating it on first use."""
+    global _shared_session
+    if _shared_session is None:
+        # A shared session with connection reuse: curl_cffi keeps one curl handle (and
+        # connection) per worker thread, each serving one request at a time. close()
+        # only releases the calling thread's handle; the rest go at process exit.
+        _shared_session = curl_requests.Session(impersonate="chrome", http_version=CurlHttpVersion.V2TLS)
+        atexit.register(_shared_session.close)
+    return _shared_session
+
+def get_cache() -> Cache:
+    """Get the on-disk cache of company metrics, creating it on first use."""
+    global _cache
+    if _cache is None:
+        _cache = Cache(CACHE_DIR)
+        atexit.register(_cache.close)
+    return _cache
+
 def calculate_rsi(prices: pd.Series, periods: int = 30) -> float:
     """Calculate the Relative Strength Index (RSI) for a given price series."""
     # Calculate price differences
@@ -124,111 +165,111 @@ def calculate_max_drawdown(prices: pd.Series) -> float:
     
     return abs(max_drawdown)  # Return as a positive number
 
-async def get_historical_data(ticker: str, period: str = "1y") -> pd.DataFrame:
+# Metrics calculated from price history rather than read from stock.info
+CALCULATED_METRICS = {
+    "rsi": calculate_rsi,
+    "returnSD": calculate_return_sd,
+    "maxDrawdown": calculate_max_drawdown
+}
+
+# Token bucket limiting the yfinance call rate while still allowing short bursts
+# (a call can make more than one HTTP request, e.g. for cookies and crumbs)
+LIMITER = AsyncLimiter(API_CALLS_PER_SECOND, 1)
+
+async def get_historical_data(stock: yf.Ticker, period: str = "1y") -> pd.DataFrame:
     """Get historical price data for a ticker."""
     try:
-        stock = yf.Ticker(ticker)
-        hist = stock.history(period=period)
+        async with LIMITER:  # Rate limiting
+            hist = await asyncio.to_thread(stock.history, period=period)
         return hist
     except Exception as e:
-        print(f"Error fetching historical data for {ticker}: {e}")
+        print(f"Error fetching historical data for {stock.ticker}: {e}")
         return pd.DataFrame()
 
-# Semaphore for limiting concurrent requests
-SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-
-async def get_metric_async(session: aiohttp.ClientSession, ticker: str, metric_name: str) -> float:
-    """Get a specific metric for a ticker asynchronously."""
-    async with SEMAPHORE:  # Limit concurrent requests
-        try:
-            await asyncio.sleep(REQUEST_DELAY)  # Rate limiting
-            stock = yf.Ticker(ticker)
-            
-            # Handle custom metrics that need calculation
-            if metric_name == "rsi":
-                hist = await get_historical_data(ticker)
-                if not hist.empty:
-                    rsi = calculate_rsi(hist['Close'])
-                    print(f"{metric_name}: {rsi}")
-                    return rsi
-                return float("nan")
-                
-            elif metric_name == "returnSD":
-                hist = await get_historical_data(ticker)
-                if not hist.empty:
-                    sd = calculate_return_sd(hist['Close'])
-                    print(f"{metric_name}: {sd}")
-                    return sd
-                return float("nan")
-                
-            elif metric_name == "maxDrawdown":
-                hist = await get_historical_data(ticker)
-                if not hist.empty:
-                    max_drawdown = calculate_max_drawdown(hist['Close'])
-                    print(f"{metric_name}: {max_drawdown}")
-                    return max_drawdown
-                return float("nan")
-                
-            # Handle standard yfinance metrics
-            value = stock.info.get(metric_name)
-            print(f"{metric_name}: {value}")
-            return value if value is not None else float("nan")
-            
-        except Exception as e:
-            print(f"Error fetching {metric_name} for {ticker}: {e}")
-            return float("nan")
-
-async def get_company_metrics_async(session: aiohttp.ClientSession, company: str, 
-                                 all_metrics: Dict[str, str]) -> Dict:
-    """Get all metrics for a single company asynchronously."""
-    company_data = {"Ticker": company}
+async def get_company_metrics_async(stock: yf.Ticker, all_metrics: Dict[str, str]) -> Tuple[float, ...]:
+    """Get all metrics for a single company asynchronously, in all_metrics order."""
+    company = stock.ticker
     
-    # Create tasks for all metrics
-    tasks = [
-        get_metric_async(session, company, yf_metric)
-        for metric_name, yf_metric in all_metrics.items()
-    ]
+    # Return cached metrics if this company was already fetched today (UTC)
+    cache_key = (company, datetime.now(timezone.utc).date().isoformat())
+    cached = get_cache().get(cache_key)
+    if cached is not None and all_metrics.keys() <= cached.keys():
+        return tuple(cached[metric_name] for metric_name in all_metrics)
     
-    # Wait for all metrics to be fetched
-    results = await asyncio.gather(*tasks)
+    info, hist = {}, pd.DataFrame()
+    # Fetch info once and pluck every standard metric from it
+    try:
+        async with LIMITER:  # Rate limiting
+            info = await asyncio.to_thread(lambda: stock.info)
+    except Exception as e:
+        print(f"Error fetching info for {company}: {e}")
+    
+    # Fetch price history once for all calculated metrics; get_historical_data
+    # handles its own errors, so an info failure doesn't lose these metrics
+    needs_history = any(yf_metric in CALCULATED_METRICS for yf_metric in all_metrics.values())
+    if needs_history:
+        hist = await get_historical_data(stock)
     
-    # Add results to company data
-    for (metric_name, _), value in zip(all_metrics.items(), results):
-        company_data[metric_name] = value
+    company_data = {}
+    for metric_name, yf_metric in all_metrics.items():
+        if yf_metric in CALCULATED_METRICS:
+            value = CALCULATED_METRICS[yf_metric](hist['Close']) if not hist.empty else None
+        else:
+            value = info.get(yf_metric)
+        company_data[metric_name] = value if value is not None else float("nan")
     
-    return company_data
+    # Only cache when every source succeeded so failures are retried on the next run
+    if info and not (needs_history and hist.empty):
+        get_cache().set(cache_key, company_data, expire=CACHE_EXPIRY)
+    
+    return tuple(company_data.values())
 
-async def process_companies_async(companies: List[str], all_metrics: Dict[str, str]) -> List[Dict]:
+async def process_company_async(stock: yf.Ticker, all_metrics: Dict[str, str],
+                                progress: tqdm) -> Tuple[float, ...]:
+    """Process a single company, returning a row of NaNs if anything fails."""
+    try:
+        return await get_company_metrics_async(stock, all_metrics)
+    except Exception as e:
+        print(f"Error processing company {stock.ticker}: {e}")
+        return (float("nan"),) * len(all_metrics)
+    finally:
+        progress.update(1)
+
+async def process_companies_async(companies: List[str], all_metrics: Dict[str, str],
+                                  progress: tqdm) -> pd.DataFrame:
     """Process a batch of companies asynchronously."""
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for company in companies:
-            task = get_company_metrics_async(session, company, all_metrics)
-            tasks.append(task)
-        
-        # Use tqdm to show progress
-        company_data_list = []
-        for future in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing companies"):
-            try:
-                result = await future
-                company_data_list.append(result)
-            except Exception as e:
-                print(f"Error processing company: {e}")
+    # Build every Ticker in one batch so they all share the session
+    tickers = yf.Tickers(" ".join(companies), session=get_shared_session())
+    stocks = list(tickers.tickers.values())
+    tasks = [process_company_async(stock, all_metrics, progress) for stock in stocks]
     
-    return company_data_list
+    # Add this batch to the shared progress bar, then gather all companies at once
+    progress.total += len(tasks)
+    progress.refresh()
+    results = await asyncio.gather(*tasks)
+    
+    # Pack the rows into a float64 record array, one field per metric
+    records = np.array(results, dtype=[(metric_name, "f8") for metric_name in all_metrics])
+    df = pd.DataFrame.from_records(records)
+    df.insert(0, "Ticker", [stock.ticker for stock in stocks])
+    
+    return df
 
 async def get_sector_companies(sector: str) -> List[str]:
     """Get companies for a given sector using yfinance."""
     try:
         # Use yfinance to get sector companies
-        sector_obj = yf.Sector(sector)
-        return list(sector_obj.top_companies.index)
+        sector_obj = yf.Sector(sector, session=get_shared_session())
+        async with LIMITER:  # Rate limiting
+            top_companies = await asyncio.to_thread(lambda: sector_obj.top_companies)
+        return list(top_companies.index)
     except Exception as e:
         print(f"Error getting companies for sector {sector}: {e}")
         return []
 
-async def process_sector_async(sector: str, metrics: Dict[str, Dict[str, str]]) -> pd.DataFrame:
-    """Process a single sector asynchronously."""
+async def process_sector_async(sector: str, metrics: Dict[str, Dict[str, str]],
+                               progress: tqdm) -> pd.DataFrame:
+    """Collect the raw company data for a single sector asynchronously."""
     try:
         companies = await get_sector_companies(sector)
         
@@ -237,20 +278,15 @@ async def process_sector_async(sector: str, metrics: Dict[str, Dict[str, str]])
             return None
             
         # Get raw data
-        company_data_list = await process_companies_async(companies, metrics["all_metrics"])
+        df = await process_companies_async(companies, metrics["all_metrics"], progress)
         
-        # Convert to DataFrame
-        df = pd.DataFrame(company_data_list)
-        
-        if df is None or df.empty:
+        if df.empty:
             print(f"No data available for sector {sector}")
             return None
             
         # Add sector column before processing
         df["Sector"] = sector
         
-        # Process data
-        df = await process_data(df, metrics)
         return df
     except Exception as e:
         print(f"Error processing sector {sector}: {e}")
@@ -262,33 +298,36 @@ async def process_data(df: pd.DataFrame, metrics: Dict[str, Dict[str, str]]) ->
         print("No data was collected successfully.")
         return None
     
-    # Calculate z-scores for each metric group
-    for metric_group in ["x1_risk_metrics", "x2_momentum_metrics", "x3_quality_metrics"]:
-        for metric_name in metrics[metric_group].keys():
-            if metric_name in df.columns:
-                df.loc[:, f"{metric_name}_ZScore"] = zscore(df[metric_name].fillna(df[metric_name].mean()), 
-                                                   nan_policy='omit')
+    # Calculate z-scores for all metric groups and PE within each sector in one pass
+    metric_cols = [metric_name
+                   for metric_group in ["x1_risk_metrics", "x2_momentum_metrics", "x3_quality_metrics"]
+                   for metric_name in metrics[metric_group].keys()
+                   if metric_name in df.columns]
+    zscore_cols = metric_cols + (["PE"] if "PE" in df.columns else [])
+    sub = df[zscore_cols]
+    # Compute the sector means once and broadcast them into the metric gaps
+    # (filling with the mean leaves it unchanged; PE gaps stay NaN and are skipped)
+    means = sub.groupby(df["Sector"]).transform("mean")
+    filled = sub.where(sub.notna() | ~sub.columns.isin(metric_cols), means)
+    stds = filled.groupby(df["Sector"]).transform("std", ddof=0)
+    df[[f"{column}_ZScore" for column in zscore_cols]] = ((filled - means) / stds).to_numpy()
     
-    # Calculate PE Z-score separately (our target variable)
+    # Remove companies with no P/E values (our target variable)
     if "PE" in df.columns:
-        # Remove companies with no P/E values
         df = df.dropna(subset=["PE"]).copy()  # Create explicit copy
-        # Calculate z-score only for remaining companies
-        df.loc[:, "PE_ZScore"] = zscore(df["PE"], nan_policy='omit')
     
-    # Calculate composite scores for each category
-    df.loc[:, "Risk_Score"] = df[[f"{metric}_ZScore" for metric in X1_RISK_METRICS.keys() 
-                          if f"{metric}_ZScore" in df.columns]].mean(axis=1)
-    df.loc[:, "Momentum_Score"] = df[[f"{metric}_ZScore" for metric in X2_MOMENTUM_METRICS.keys() 
-                            if f"{metric}_ZScore" in df.columns]].mean(axis=1)
-    df.loc[:, "Quality_Score"] = df[[f"{metric}_ZScore" for metric in X3_QUALITY_METRICS.keys() 
-                             if f"{metric}_ZScore" in df.columns]].mean(axis=1)
+    # Calculate composite scores for each category on plain NumPy arrays
+    with warnings.catch_warnings():
+        # Rows with no z-scores in a category score NaN, like DataFrame.mean(axis=1)
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        df["Risk_Score"] = np.nanmean(df[RISK_Z_COLS].to_numpy(), axis=1)
+        df["Momentum_Score"] = np.nanmean(df[MOMENTUM_Z_COLS].to_numpy(), axis=1)
+        df["Quality_Score"] = np.nanmean(df[QUALITY_Z_COLS].to_numpy(), axis=1)
     
     # Filter out data points with extreme z-scores (>3 standard deviations)
-    mask = (abs(df["Risk_Score"]) <= 2.5) & \
-           (abs(df["Momentum_Score"]) <= 2.5) & \
-           (abs(df["Quality_Score"]) <= 2.5) & \
-           (abs(df["PE_ZScore"]) <= 2.5)  
+    # A NaN score propagates through max() and drops the row
+    scores = df[["Risk_Score", "Momentum_Score", "Quality_Score", "PE_ZScore"]].to_numpy()
+    mask = np.abs(scores).max(axis=1) <= 2.5
     df = df[mask]
     
     # Keep only essential columns
@@ -303,27 +342,37 @@ async def process_data(df: pd.DataFrame, metrics: Dict[str, Dict[str, str]]) ->
 async def analyze_sectors_async(sectors: List[str] = SECTORS) -> pd.DataFrame:
     """Analyze multiple sectors with controlled concurrency."""
     all_data = []
-    all_data_full = []
     
-    for sector in tqdm(sectors, desc="Processing sectors"):
-        await asyncio.sleep(INDUSTRY_DELAY)  # Rate limiting between sectors
-        full_data, sector_data = await process_sector_async(sector, METRICS)
-        if sector_data is not None:
-            all_data.append(sector_data)
-        if full_data is not None:
-            all_data_full.append(full_data)
+    # Blocking yfinance calls run in threads, so size the pool past the default
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=MAX_WORKER_THREADS))
+    
+    # Run all sectors concurrently; LIMITER bounds the load on the API. Sectors
+    # share one progress bar, growing its total as their companies are listed
+    with tqdm(total=0, desc="Processing companies") as progress:
+        results = await asyncio.gather(*[process_sector_async(sector, METRICS, progress)
+                                         for sector in sectors],
+                                       return_exceptions=True)
+    
+    for sector, result in zip(sectors, results):
+        if isinstance(result, Exception):
+            print(f"Error processing sector {sector}: {result}")
+            continue
+        if result is not None:
+            all_data.append(result)
     
     if not all_data:
         print("No data was collected successfully.")
         return None
     
-    # Combine all sector data
-    combined_data = pd.concat(all_data, ignore_index=True)
-    combined_data_full = pd.concat(all_data_full, ignore_index=True)
+    # Combine the raw sector data, then process all sectors in a single pass
+    df = pd.concat(all_data, ignore_index=True)
+    combined_data_full, combined_data = await process_data(df, METRICS)
+    combined_data_full = combined_data_full.reset_index(drop=True)
+    combined_data = combined_data.reset_index(drop=True)
     
-    # Save to CSV
-    combined_data.to_csv("sector_analysis.csv", index=False)
-    combined_data_full.to_csv("sector_analysis_full.csv", index=False)
+    # Save to CSV with Arrow's multithreaded C++ writer
+    pacsv.write_csv(pa.Table.from_pandas(combined_data, preserve_index=False), "sector_analysis.csv")
+    pacsv.write_csv(pa.Table.from_pandas(combined_data_full, preserve_index=False), "sector_analysis_full.csv")
     return combined_data
 
 if __name__ == "__main__":